@@ -59,15 +59,14 @@ import sys
 import time
 import traceback
 
-from collections import defaultdict
+from collections import defaultdict, deque
 from functools import reduce as _reduce
 
 from insights.contrib import importlib
-from insights.contrib.toposort import toposort_flatten
 from insights.core.blacklist import BLACKLISTED_SPECS
 from insights.core.context import SerializedArchiveContext
 from insights.core.exceptions import BlacklistedSpec, MissingRequirements, SkipComponent
-from insights.util import defaults, enum, KeyPassingDefaultDict
+from insights.util import enum, KeyPassingDefaultDict
 
 log = logging.getLogger(__name__)
 
@@ -76,7 +75,7 @@ GROUPS = enum("single", "cluster")
 MODULE_NAMES = {}
 BASE_MODULE_NAMES = {}
 
-TYPE_OBSERVERS = defaultdict(set)
+TYPE_OBSERVERS = defaultdict(frozenset)
 
 COMPONENTS_BY_TYPE = defaultdict(set)
 DEPENDENCIES = defaultdict(set)
@@ -85,6 +84,19 @@ COMPONENTS = defaultdict(lambda: defaultdict(set))
 
 DELEGATES = {}
 HIDDEN = set()
+
+# component -> type and component -> group, filled in at registration so the
+# hot lookups don't have to go through the delegate.
+_TYPE_CACHE = {}
+_GROUP_CACHE = {}
+
+# Bumped whenever the dependency state changes so cached run orders of the
+# component groups can be discarded.
+_DEP_EPOCH = 0
+_ORDER_CACHE = {}
+
+# Set by seal() and cleared as soon as the dependency state changes again.
+_SEALED = False
 IGNORE = defaultdict(set)
 ENABLED = defaultdict(lambda: True)
 
@@ -143,29 +155,33 @@ def hashable(v):
     return True
 
 
-def _get_from_module(name):
-    mod, _, n = name.rpartition(".")
-    if mod not in sys.modules:
-        importlib.import_module(mod)
-    return getattr(sys.modules[mod], n)
-
-
-def _get_from_class(name):
-    mod, _, n = name.rpartition(".")
-    cls = _get_from_module(mod)
-    return getattr(cls, n)
+_MISSING = object()
 
 
 def _import_component(name):
     """
     Returns a class, function, or class method specified by the fully qualified
     name.
+
+    The longest prefix of the name that is a module is found, checking
+    ``sys.modules`` before importing anything, and the rest of the name is
+    resolved as attributes of that module.
     """
-    for f in (_get_from_module, _get_from_class):
-        try:
-            return f(name)
-        except:
-            pass
+    parts = name.split(".")
+    for i in range(len(parts) - 1, 0, -1):
+        mod = ".".join(parts[:i])
+        obj = sys.modules.get(mod)
+        if obj is None:
+            try:
+                obj = importlib.import_module(mod)
+            except ImportError:
+                continue
+        for attr in parts[i:]:
+            obj = getattr(obj, attr, _MISSING)
+            if obj is _MISSING:
+                break
+        else:
+            return obj
 
 
 COMPONENT_IMPORT_CACHE = KeyPassingDefaultDict(_import_component)
@@ -193,21 +209,28 @@ def get_component_by_name(name):
     return COMPONENTS_BY_NAME[name]
 
 
-@defaults(None)
 def get_component_type(component):
-    return get_delegate(component).type
+    try:
+        return _TYPE_CACHE.get(component)
+    except TypeError:
+        # unhashable, so it can't be a component
+        return None
 
 
 def get_components_of_type(_type):
     return COMPONENTS_BY_TYPE.get(_type)
 
 
-@defaults(None)
 def get_group(component):
-    return get_delegate(component).group
+    try:
+        return _GROUP_CACHE.get(component)
+    except TypeError:
+        return None
 
 
 def add_dependent(component, dep):
+    if _SEALED:
+        _unseal()
     DEPENDENTS[component].add(dep)
 
 
@@ -215,9 +238,12 @@ def get_dependents(component):
     return DEPENDENTS.get(component, set())
 
 
-@defaults(set())
 def get_dependencies(component):
-    return get_delegate(component).get_dependencies()
+    try:
+        delegate = DELEGATES.get(component)
+    except TypeError:
+        return set()
+    return delegate.get_dependencies() if delegate is not None else set()
 
 
 def add_dependency(component, dep):
@@ -266,6 +292,9 @@ def get_links(component):
 
 
 def get_module_name(obj):
+    name = getattr(obj, "__module__", None)
+    if isinstance(name, six.string_types):
+        return name
     try:
         return inspect.getmodule(obj).__name__
     except:
@@ -301,20 +330,27 @@ def walk_tree(root, method=get_dependencies):
 def walk_dependencies(root, visitor):
     """
     Call visitor on root and all dependencies reachable from it in breadth
-    first order.
+    first order. The visitor is called once for every edge, but the
+    dependencies of each component are only walked once.
 
     Args:
         root (component): component function or class
         visitor (function): signature is `func(component, parent)`.  The
             call on root is `visitor(root, None)`.
     """
-    def visit(parent, visitor):
-        for d in get_dependencies(parent):
-            visitor(d, parent)
-            visit(d, visitor)
-
     visitor(root, None)
-    visit(root, visitor)
+    seen = set([root])
+    queue = deque([root])
+    while queue:
+        parent = queue.popleft()
+        delegate = DELEGATES.get(parent)
+        if delegate is None:
+            continue
+        for d in delegate.get_dependencies_tuple():
+            visitor(d, parent)
+            if d not in seen:
+                seen.add(d)
+                queue.append(d)
 
 
 def get_dependency_graph(component):
@@ -476,28 +512,43 @@ def get_subgraphs(graph=None):
     graph = graph or DEPENDENCIES
     # Sort the keys as per "prio", 0 -> no priority
     keys = sorted(graph, key=lambda x: getattr(next(iter(get_registry_points(x) or [object])), 'prio', 0), reverse=True)
-    frontier = set()
-    seen = set()
-    while keys:
-        frontier.add(keys.pop(0))
-        while frontier:
-            component = frontier.pop()
-            seen.add(component)
-            frontier |= set([d for d in get_dependencies(component) if d in graph])
-            frontier |= set([d for d in get_dependents(component) if d in graph])
-            frontier -= seen
-        yield dict((s, get_dependencies(s)) for s in seen)
-        # Remove processed keys without changing their order
-        for s in seen:
-            try:
-                keys.remove(s)
-            except Exception:
-                pass
-        seen.clear()
+
+    # Union-find over the components in the graph, linking each to its
+    # dependencies and dependents that are also in the graph.
+    parent = dict((k, k) for k in keys)
+
+    def find(c):
+        root = c
+        while parent[root] is not root:
+            root = parent[root]
+        while parent[c] is not root:
+            parent[c], c = root, parent[c]
+        return root
+
+    for component in keys:
+        for d in get_dependencies(component):
+            if d in parent:
+                parent[find(d)] = find(component)
+        for d in get_dependents(component):
+            if d in parent:
+                parent[find(d)] = find(component)
+
+    # Keep the sub-graphs in the order of their highest priority component.
+    roots = []
+    members = {}
+    for component in keys:
+        root = find(component)
+        if root not in members:
+            members[root] = []
+            roots.append(root)
+        members[root].append(component)
+
+    for root in roots:
+        yield dict((s, get_dependencies(s)) for s in members[root])
 
 
 def _import(path, continue_on_error):
-    log.debug("Importing %s" % path)
+    log.debug("Importing %s", path)
     try:
         return importlib.import_module(path)
     except BaseException:
@@ -505,37 +556,43 @@ def _import(path, continue_on_error):
             raise
 
 
-def _load_components(path, include=".*", exclude="\\.tests", continue_on_error=True):
-    do_include = re.compile(include).search if include else lambda x: True
-    do_exclude = re.compile(exclude).search if exclude else lambda x: False
+def _iter_submodules(package):
+    prefix = package.__name__ + "."
+    for _, name, is_pkg in pkgutil.iter_modules(path=package.__path__, prefix=prefix):
+        if not name.startswith(prefix):
+            name = prefix + name
+        yield name, is_pkg
 
-    num_loaded = 0
+
+def _load_components(path, do_include, do_exclude, continue_on_error):
     if path.endswith(".py"):
         path, _ = os.path.splitext(path)
 
     path = path.rstrip("/").replace("/", ".")
-    if do_exclude(path):
-        return 0
 
-    package = _import(path, continue_on_error)
-    if not package:
-        return 0
-
-    num_loaded += 1
-
-    if not hasattr(package, "__path__"):
-        return num_loaded
+    # Walk the package tree depth first with a stack of module iterators.
+    # Packages are only imported and descended into if they aren't excluded.
+    num_loaded = 0
+    pending = [iter([(path, True)])]
+    while pending:
+        try:
+            name, is_pkg = next(pending[-1])
+        except StopIteration:
+            pending.pop()
+            continue
 
-    prefix = package.__name__ + "."
-    for _, name, is_pkg in pkgutil.iter_modules(path=package.__path__, prefix=prefix):
-        if not name.startswith(prefix):
-            name = prefix + name
         if is_pkg:
-            num_loaded += _load_components(name, include, exclude, continue_on_error)
-        else:
-            if do_include(name) and not do_exclude(name):
-                _import(name, continue_on_error)
-                num_loaded += 1
+            if do_exclude(name):
+                continue
+            package = _import(name, continue_on_error)
+            if not package:
+                continue
+            num_loaded += 1
+            if hasattr(package, "__path__"):
+                pending.append(_iter_submodules(package))
+        elif do_include(name) and not do_exclude(name):
+            _import(name, continue_on_error)
+            num_loaded += 1
 
     return num_loaded
 
@@ -562,12 +619,58 @@ def load_components(*paths, **kwargs):
     Raises:
         ImportError
     """
+    include = kwargs.get("include", ".*")
+    exclude = kwargs.get("exclude", "\\.tests")
+    continue_on_error = kwargs.get("continue_on_error", True)
+
+    do_include = re.compile(include).search if include else lambda x: True
+    do_exclude = re.compile(exclude).search if exclude else lambda x: False
+
     num_loaded = 0
     for path in paths:
-        num_loaded += _load_components(path, **kwargs)
+        num_loaded += _load_components(path, do_include, do_exclude, continue_on_error)
     return num_loaded
 
 
+def seal():
+    """
+    Freeze the dependency maps once all components have been loaded.
+
+    The values of ``DEPENDENCIES``, ``DEPENDENTS`` and the graphs in
+    ``COMPONENTS`` become frozensets so they can't be changed by accident,
+    and looking up an unknown component in them raises a ``KeyError``
+    instead of silently adding it. Getters like :func:`get_dependents` still
+    return sets either way; they're just immutable while the maps are
+    sealed.
+
+    The run order of every group is computed and cached here. If a group
+    contains a cycle, ``ValueError`` is raised and nothing is sealed.
+
+    Registering a component or adding a dependency afterwards unseals the
+    maps again, so calling this early is safe, just not useful.
+    """
+    global _SEALED
+    if _SEALED:
+        return
+    # Sort first so a cycle leaves everything untouched.
+    orders = dict((id(g), (_DEP_EPOCH, g, tuple(_run_order(g)))) for g in COMPONENTS.values())
+    for d in [DEPENDENCIES, DEPENDENTS] + list(COMPONENTS.values()):
+        d.default_factory = None
+        for k, v in d.items():
+            d[k] = frozenset(v)
+    _ORDER_CACHE.update(orders)
+    _SEALED = True
+
+
+def _unseal():
+    global _SEALED
+    for d in [DEPENDENCIES, DEPENDENTS] + list(COMPONENTS.values()):
+        d.default_factory = set
+        for k, v in d.items():
+            d[k] = set(v)
+    _SEALED = False
+
+
 def first_of(dependencies, broker):
     for d in dependencies:
         if d in broker:
@@ -597,10 +700,14 @@ def stringify_requirements(requires):
 
 
 def _register_component(delegate):
+    global _DEP_EPOCH
+    _DEP_EPOCH += 1
+    if _SEALED:
+        _unseal()
     component = delegate.component
 
     dependencies = delegate.get_dependencies()
-    DEPENDENCIES[component] = dependencies
+    DEPENDENCIES[component] = set(dependencies)
     COMPONENTS[delegate.group][component] |= dependencies
 
     COMPONENTS_BY_TYPE[delegate.type].add(component)
@@ -608,6 +715,8 @@ def _register_component(delegate):
         if issubclass(delegate.type, k) and delegate.type is not k:
             v.add(component)
     DELEGATES[component] = delegate
+    _TYPE_CACHE[component] = delegate.type
+    _GROUP_CACHE[component] = delegate.group
 
     MODULE_NAMES[component] = get_module_name(component)
     BASE_MODULE_NAMES[component] = get_base_module_name(component)
@@ -739,7 +848,8 @@ class ComponentType(object):
 
         self.deps.extend(self.optional)
 
-        self.dependencies = set(self.deps)
+        self.dependencies = frozenset(self.deps)
+        self._dep_tuple = tuple(self.dependencies)
 
         self.metadata = {}
         self.metadata.update(self.__class__.metadata)
@@ -774,17 +884,16 @@ class ComponentType(object):
         Handles invocation of the component. The default implementation invokes
         it with positional arguments based on order of dependency declaration.
         """
-        args = [results.get(d) for d in self.deps]
-        return self.component(*args)
+        get = results.instances.get if isinstance(results, Broker) else results.get
+        return self.component(*[get(d) for d in self.deps])
 
     def get_missing_dependencies(self, broker):
         """
         Gets required and at-least-one dependencies not provided by the broker.
         """
-        missing_required = [r for r in self.requires if r not in broker]
-        missing_at_least_one = [d for d in self.at_least_one if not set(d).intersection(broker)]
-        if missing_required or missing_at_least_one:
-            return (missing_required, missing_at_least_one)
+        if not self.requires and not self.at_least_one:
+            return None
+        return _get_missing(self.requires, self.at_least_one, broker)
 
     def process(self, broker):
         """
@@ -800,11 +909,24 @@ class ComponentType(object):
     def get_dependencies(self):
         return self.dependencies
 
+    def get_dependencies_tuple(self):
+        """
+        Same as :meth:`get_dependencies` but as a tuple, which is cheaper to
+        iterate.
+        """
+        return self._dep_tuple
+
     def add_dependency(self, dep):
+        global _DEP_EPOCH
+        _DEP_EPOCH += 1
+        if _SEALED:
+            _unseal()
         group = self.group
         self.at_least_one[0].append(dep)
         self.deps.append(dep)
-        self.dependencies.add(dep)
+        if dep not in self.dependencies:
+            self.dependencies = self.dependencies | frozenset([dep])
+            self._dep_tuple = self._dep_tuple + (dep,)
         add_dependent(dep, self.component)
 
         DEPENDENCIES[self.component].add(dep)
@@ -845,19 +967,22 @@ class Broker(object):
     """
     def __init__(self, seed_broker=None):
         self.instances = dict(seed_broker.instances) if seed_broker else {}
+        self._by_type = defaultdict(dict)
+        if seed_broker is not None:
+            for k, v in seed_broker._by_type.items():
+                self._by_type[k] = dict(v)
         self.missing_requirements = {}
         self.exceptions = defaultdict(list)
         self.tracebacks = {}
         self.exec_times = {}
         self.store_skips = False
 
-        self.observers = defaultdict(set)
+        # The observer sets are never modified in place, so they can be
+        # shared with TYPE_OBSERVERS or the seed broker instead of copied.
         if seed_broker is not None:
-            self.observers.update(seed_broker.observers)
+            self.observers = dict(seed_broker.observers)
         else:
-            self.observers[ComponentType] = set()
-            for k, v in TYPE_OBSERVERS.items():
-                self.observers[k] |= set(v)
+            self.observers = dict(TYPE_OBSERVERS)
 
     def observer(self, component_type=ComponentType):
         """
@@ -891,7 +1016,7 @@ class Broker(object):
 
         """
 
-        self.observers[component_type].add(o)
+        self.observers[component_type] = self.observers.get(component_type, frozenset()) | frozenset([o])
 
     def fire_observers(self, component):
         _type = get_component_type(component)
@@ -929,11 +1054,7 @@ class Broker(object):
         """
         Return all of the instances of :class:`ComponentType` ``_type``.
         """
-        r = {}
-        for k, v in self.items():
-            if get_component_type(k) is _type:
-                r[k] = v
-        return r
+        return dict(self._by_type.get(_type, {}))
 
     def __contains__(self, component):
         return component in self.instances
@@ -944,10 +1065,12 @@ class Broker(object):
             raise KeyError(msg % get_name(component))
 
         self.instances[component] = instance
+        self._by_type[get_component_type(component)][component] = instance
 
     def __delitem__(self, component):
         if component in self.instances:
             del self.instances[component]
+            self._by_type[get_component_type(component)].pop(component, None)
             return
 
     def __getitem__(self, component):
@@ -957,17 +1080,29 @@ class Broker(object):
         raise KeyError("Unknown component: %s" % get_name(component))
 
     def get(self, component, default=None):
-        try:
-            return self[component]
-        except KeyError:
-            return default
+        return self.instances.get(component, default)
 
     def print_component(self, component_type):
         print(json.dumps(
-            dict((get_name(c), self[c])
+            dict((get_name(c), self.instances[c])
                  for c in sorted(self.get_by_type(component_type), key=get_name))))
 
 
+def _get_missing(req_all, req_any, broker):
+    """
+    Returns the ``(req_all, req_any)`` requirements not provided by broker, or
+    None if they're all met. broker can be a :class:`Broker` or anything that
+    supports ``in``.
+    """
+    # check membership against the requirements instead of intersecting
+    # with the broker, which would walk every instance it holds
+    present = broker.instances if isinstance(broker, Broker) else broker
+    missing_all = [r for r in req_all if r not in present]
+    missing_any = [r for r in req_any if not any(i in present for i in r)]
+    if missing_all or missing_any:
+        return missing_all, missing_any
+
+
 def get_missing_requirements(func, requires, d):
     """
     .. deprecated:: 1.x
@@ -977,13 +1112,7 @@ def get_missing_requirements(func, requires, d):
     if any(i in d for i in IGNORE.get(func, [])):
         raise SkipComponent()
     req_all, req_any = split_requirements(requires)
-    d = set(d.keys())
-    req_all = [r for r in req_all if r not in d]
-    req_any = [r for r in req_any if set(r).isdisjoint(d)]
-    if req_all or req_any:
-        return req_all, req_any
-    else:
-        return None
+    return _get_missing(req_all, req_any, d)
 
 
 def add_observer(o, component_type=ComponentType):
@@ -1009,7 +1138,7 @@ def add_observer(o, component_type=ComponentType):
 
     """
 
-    TYPE_OBSERVERS[component_type].add(o)
+    TYPE_OBSERVERS[component_type] = TYPE_OBSERVERS[component_type] | frozenset([o])
 
 
 def observer(component_type=ComponentType):
@@ -1027,8 +1156,58 @@ def run_order(graph):
     """
     Returns components in an order that satisfies their dependency
     relationships.
+
+    The order is computed with Kahn's algorithm: components without
+    dependencies are emitted first, in the order they appear in the graph, and
+    each dependent is emitted as soon as the last of its dependencies has been.
+
+    The order of a component group in ``COMPONENTS`` is cached until a
+    component is registered or a dependency is added.
+
+    Raises:
+        ValueError: if the graph contains a cycle.
     """
-    return toposort_flatten(graph, sort=False)
+    if not any(graph is g for g in COMPONENTS.values()):
+        return _run_order(graph)
+
+    # The entry holds on to the graph itself so a new dict that happens to
+    # get the id of a discarded group can't pick up its order.
+    key = id(graph)
+    cached = _ORDER_CACHE.get(key)
+    if cached is None or cached[0] != _DEP_EPOCH or cached[1] is not graph:
+        cached = (_DEP_EPOCH, graph, tuple(_run_order(graph)))
+        _ORDER_CACHE[key] = cached
+    return list(cached[2])
+
+
+def _run_order(graph):
+    components = list(graph)
+    in_degree = dict.fromkeys(components, 0)
+    dependents = defaultdict(list)
+    for component, deps in graph.items():
+        for dep in deps:
+            if dep == component:
+                continue
+            if dep not in in_degree:
+                in_degree[dep] = 0
+                components.append(dep)
+            in_degree[component] += 1
+            dependents[dep].append(component)
+
+    queue = deque(c for c in components if not in_degree[c])
+    order = []
+    while queue:
+        component = queue.popleft()
+        order.append(component)
+        for dep in dependents.get(component, ()):
+            in_degree[dep] -= 1
+            if not in_degree[dep]:
+                queue.append(dep)
+
+    if len(order) != len(components):
+        cyclic = [c for c in components if in_degree[c]]
+        raise ValueError("Cyclic dependencies exist among these items: %s" % ", ".join(get_name(c) for c in cyclic))
+    return order
 
 
 def determine_components(components):
@@ -1061,15 +1240,22 @@ def run_components(ordered_components, components, broker):
     This function allows callers to order components themselves and cache the
     result so they don't incur the toposort overhead on every run.
     """
+    # local aliases for the per-component lookups below
+    instances = broker.instances
+    delegates = DELEGATES
+    enabled = ENABLED
+    exec_times = broker.exec_times
+    fire_observers = broker.fire_observers
+
     for component in ordered_components:
         start = time.time()
         try:
-            if (component not in broker and component in components and
-               component in DELEGATES and
-               is_enabled(component)):
-                log.info("Trying %s" % get_name(component))
-                result = DELEGATES[component].process(broker)
-                broker[component] = result
+            delegate = delegates.get(component)
+            if (delegate is not None and component not in instances and
+                    component in components and enabled[component]):
+                if log.isEnabledFor(logging.INFO):
+                    log.info("Trying %s", get_name(component))
+                broker[component] = delegate.process(broker)
         except BlacklistedSpec as bs:
             for x in get_registry_points(component):
                 BLACKLISTED_SPECS.append(str(x).split('.')[-1])
@@ -1078,7 +1264,7 @@ def run_components(ordered_components, components, broker):
             if log.isEnabledFor(logging.DEBUG):
                 name = get_name(component)
                 reqs = stringify_requirements(mr.requirements)
-                log.debug("%s missing requirements %s" % (name, reqs))
+                log.debug("%s missing requirements %s", name, reqs)
             broker.add_exception(component, mr)
         except SkipComponent as sc:
             if broker.store_skips:
@@ -1093,8 +1279,8 @@ def run_components(ordered_components, components, broker):
             for reg_spec in get_registry_points(component):
                 broker.add_exception(reg_spec, ex, tb)
         finally:
-            broker.exec_times[component] = time.time() - start
-            broker.fire_observers(component)
+            exec_times[component] = time.time() - start
+            fire_observers(component)
 
     return broker
 
@@ -1121,9 +1307,12 @@ def run(components=None, broker=None):
     # If a SerializedArchiveContext then data found in the archive's
     # ./meta_data directory are prepopulated in the broker as Specs so
     # no need to collect them again
-    if broker.get(SerializedArchiveContext) is not None:
+    instances = broker.instances
+    if instances.get(SerializedArchiveContext) is not None:
+        # don't prune the registered component groups themselves
+        components = dict(components)
         for comp in list(components):
-            if comp in broker:
+            if comp in instances:
                 for dep in components[comp]:
                     components.pop(dep, None)
     return run_components(run_order(components), components, broker)
@@ -0,0 +1,305 @@
+import pytest
+import sys
+
+from collections import defaultdict
+
+from insights import dr
+from insights.core import plugins
+
+
+class needs(dr.ComponentType):
+    group = "graph_tests"
+
+
+@needs()
+def base():
+    return 1
+
+
+@needs(base)
+def left(b):
+    return b + 1
+
+
+@needs(base)
+def right(b):
+    return b + 2
+
+
+@needs(left, right)
+def top(l, r):
+    return l + r
+
+
+def test_walk_dependencies_visits_every_edge():
+    edges = []
+
+    def visitor(c, parent):
+        edges.append((parent, c))
+
+    dr.walk_dependencies(top, visitor)
+    assert edges[0] == (None, top)
+    assert sorted(edges[1:3], key=lambda e: dr.get_name(e[1])) == [(top, left), (top, right)]
+    assert sorted(edges[3:], key=lambda e: dr.get_name(e[0])) == [(left, base), (right, base)]
+
+
+def test_get_dependency_graph_shared_dependency():
+    graph = dr.get_dependency_graph(top)
+    assert graph == {
+        top: set([left, right]),
+        left: set([base]),
+        right: set([base]),
+        base: set(),
+    }
+
+
+def test_run_order():
+    order = dr.run_order(dr.get_dependency_graph(top))
+    assert len(order) == 4
+    assert order[0] is base
+    assert order[-1] is top
+
+
+def test_run_order_includes_dependency_only_items():
+    order = dr.run_order({"b": set(["a"]), "c": set(["b", "a"])})
+    assert order == ["a", "b", "c"]
+
+
+def test_run_order_ignores_self_dependencies():
+    assert dr.run_order({"a": set(["a"]), "b": set(["a"])}) == ["a", "b"]
+
+
+def test_run_order_cycle():
+    with pytest.raises(ValueError):
+        dr.run_order({"a": set(["b"]), "b": set(["a"])})
+
+
+def test_run_order_group_cache():
+    graph = dr.COMPONENTS["graph_tests"]
+    order = dr.run_order(graph)
+    assert dr.run_order(graph) == order
+
+    @needs(top)
+    def extra(t):
+        return t
+
+    order = dr.run_order(graph)
+    assert order[-1] is extra
+
+
+def test_run_order_group_cache_checks_graph(monkeypatch):
+    old = dr.COMPONENTS["graph_tests"]
+    assert dr.run_order(old)
+
+    monkeypatch.setattr(dr, "COMPONENTS", defaultdict(lambda: defaultdict(set)))
+    graph = dr.COMPONENTS["graph_tests"]
+    # pretend the new group got the id of the discarded one
+    monkeypatch.setitem(dr._ORDER_CACHE, id(graph), dr._ORDER_CACHE[id(old)])
+    assert dr.run_order(graph) == []
+
+
+def test_add_dependency():
+    @needs([base])
+    def point(b):
+        return b
+
+    before = dr.get_dependencies(point)
+    dr.add_dependency(point, left)
+    deps = dr.get_dependencies(point)
+    assert deps == frozenset([base, left])
+    assert before == frozenset([base])
+    assert set(dr.get_delegate(point).get_dependencies_tuple()) == deps
+    assert dr.DEPENDENCIES[point] == set([base, left])
+    assert point in dr.get_dependents(left)
+
+
+def test_get_missing_dependencies():
+    @needs(base, [left, right])
+    def report(b, l, r):
+        return b
+
+    delegate = dr.get_delegate(report)
+    broker = dr.Broker()
+    assert delegate.get_missing_dependencies(broker) == ([base], [[left, right]])
+
+    broker[base] = 1
+    broker[right] = 3
+    assert delegate.get_missing_dependencies(broker) is None
+    assert delegate.get_missing_dependencies(set([base])) == ([], [[left, right]])
+    assert dr.get_delegate(base).get_missing_dependencies(broker) is None
+
+
+class other(dr.ComponentType):
+    pass
+
+
+@other()
+def unrelated():
+    return 5
+
+
+def test_broker_get_by_type():
+    broker = dr.Broker()
+    broker[base] = 1
+    broker[left] = 2
+    broker[unrelated] = 5
+    broker["plain"] = 0
+    assert broker.get_by_type(needs) == {base: 1, left: 2}
+    assert broker.get_by_type(other) == {unrelated: 5}
+
+    del broker[left]
+    assert broker.get_by_type(needs) == {base: 1}
+
+    seeded = dr.Broker(broker)
+    seeded[right] = 3
+    assert seeded.get_by_type(needs) == {base: 1, right: 3}
+    assert broker.get_by_type(needs) == {base: 1}
+
+
+def test_get_subgraphs():
+    graph = dr.get_dependency_graph(top)
+    graph[unrelated] = set()
+    subgraphs = list(dr.get_subgraphs(graph))
+    assert len(subgraphs) == 2
+    assert sorted(len(g) for g in subgraphs) == [1, 4]
+    for g in subgraphs:
+        if unrelated in g:
+            assert g == {unrelated: set()}
+        else:
+            assert set(g) == set([top, left, right, base])
+
+
+def test_broker_observers_are_not_shared():
+    seen = []
+
+    def observer(c, broker):
+        seen.append(c)
+
+    parent = dr.Broker()
+    child = dr.Broker(parent)
+    child.add_observer(observer, needs)
+    assert observer not in parent.observers.get(needs, ())
+    assert observer not in dr.TYPE_OBSERVERS.get(needs, ())
+
+    child.fire_observers(base)
+    parent.fire_observers(base)
+    assert seen == [base]
+
+
+def test_seal():
+    graph = dr.COMPONENTS["graph_tests"]
+    order = dr.run_order(graph)
+    dr.seal()
+    try:
+        assert dr.DEPENDENCIES[top] == frozenset([left, right])
+        assert isinstance(dr.get_dependents(base), frozenset)
+        assert dr.get_dependents(base) >= set([left, right])
+        assert isinstance(graph[top], frozenset)
+        with pytest.raises(KeyError):
+            dr.DEPENDENCIES["not registered"]
+        assert dr.run_order(graph) == order
+        assert dr.run(graph)[top] == 5
+
+        @needs(top)
+        def after_seal(t):
+            return t
+
+        assert dr.DEPENDENCIES[after_seal] == set([top])
+        assert dr.DEPENDENTS[top] >= set([after_seal])
+        assert graph[top] == set([left, right])
+    finally:
+        dr._unseal()
+
+
+def test_load_components(tmpdir, monkeypatch):
+    root = tmpdir.mkdir("dr_load_pkg")
+    root.join("__init__.py").write("")
+    root.join("keep_a.py").write("")
+    root.join("skip_b.py").write("")
+    sub = root.mkdir("sub")
+    sub.join("__init__.py").write("")
+    sub.join("keep_c.py").write("")
+    tests = root.mkdir("tests")
+    tests.join("__init__.py").write("raise Exception('excluded package was imported')")
+    tests.join("keep_d.py").write("")
+    monkeypatch.syspath_prepend(tmpdir.strpath)
+
+    # dr_load_pkg, keep_a, sub and keep_c; packages count even when they
+    # don't match include
+    assert dr.load_components("dr_load_pkg", include="keep", continue_on_error=False) == 4
+    assert "dr_load_pkg.sub.keep_c" in sys.modules
+    assert "dr_load_pkg.skip_b" not in sys.modules
+    assert "dr_load_pkg.tests" not in sys.modules
+
+
+@pytest.fixture
+def component_pkg(tmpdir, monkeypatch):
+    root = tmpdir.mkdir("dr_comp_pkg")
+    root.join("__init__.py").write("")
+    root.join("nested.py").write(
+        "class Outer(object):\n"
+        "    class Inner(object):\n"
+        "        def method(self):\n"
+        "            pass\n"
+    )
+    root.join("broken.py").write("raise RuntimeError('broken at import')\n")
+    monkeypatch.syspath_prepend(tmpdir.strpath)
+
+
+def test_get_component_nested_attribute(component_pkg):
+    from dr_comp_pkg.nested import Outer
+    assert dr.get_component("dr_comp_pkg.nested.Outer.Inner") is Outer.Inner
+    assert dr.get_component("dr_comp_pkg.nested.Outer.Inner.method") == Outer.Inner.method
+
+
+def test_get_component_missing(component_pkg):
+    assert dr.get_component("dr_comp_pkg.nested.Outer.Missing") is None
+    assert dr.get_component("dr_comp_pkg.missing_module.Thing") is None
+
+
+def test_get_component_import_error_propagates(component_pkg):
+    with pytest.raises(RuntimeError):
+        dr.get_component("dr_comp_pkg.broken.Thing")
+
+
+def test_getters_unhashable():
+    assert dr.get_component_type({}) is None
+    assert dr.get_group([]) is None
+    assert dr.get_dependencies({}) == set()
+    assert plugins.is_component({}) is False
+
+
+def test_seal_with_cycle():
+    class cyclic(dr.ComponentType):
+        group = "cyclic_tests"
+
+    @cyclic(["cyclic_seed"])
+    def a(b):
+        return b
+
+    @cyclic([a])
+    def b(a):
+        return a
+
+    dr.add_dependency(a, b)
+    try:
+        with pytest.raises(ValueError):
+            dr.seal()
+        assert not dr._SEALED
+        assert isinstance(dr.DEPENDENCIES[a], set)
+
+        @needs(top)
+        def after_failed_seal(t):
+            return t
+
+        assert dr.DEPENDENCIES[after_failed_seal] == set([top])
+    finally:
+        # unregister the cycle so it can't trip up other tests
+        del dr.COMPONENTS["cyclic_tests"]
+        del dr.COMPONENTS_BY_TYPE[cyclic]
+        for c in (a, b):
+            for by_type in dr.COMPONENTS_BY_TYPE.values():
+                by_type.discard(c)
+            for registry in (dr.DELEGATES, dr.DEPENDENCIES, dr.DEPENDENTS, dr._TYPE_CACHE, dr._GROUP_CACHE):
+                registry.pop(c, None)
+        dr.DEPENDENTS.pop("cyclic_seed", None)
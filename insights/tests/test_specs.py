@@ -434,5 +434,5 @@ def test_specs_collect(obfuscate):
 
     # Reset Test ENV
     dr.COMPONENTS = defaultdict(lambda: defaultdict(set))
-    dr.TYPE_OBSERVERS = defaultdict(set)
+    dr.TYPE_OBSERVERS = defaultdict(frozenset)
     dr.ENABLED = defaultdict(lambda: True)
@@ -133,7 +133,7 @@ def teardown_function(func):
 
     # Reset Test ENV
     dr.COMPONENTS = defaultdict(lambda: defaultdict(set))
-    dr.TYPE_OBSERVERS = defaultdict(set)
+    dr.TYPE_OBSERVERS = defaultdict(frozenset)
     dr.ENABLED = defaultdict(lambda: True)
 
 